@@ -2,12 +2,13 @@ import argparse
 import os
 import time
 from collections import OrderedDict
-from copy import deepcopy
 
 import medmnist
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 import torch.utils.data as data
 import torchvision.transforms as transforms
@@ -16,14 +17,20 @@ from medmnist import INFO, Evaluator
 from models import ResNet18, ResNet50, VisionTransformer3D
 from tensorboardX import SummaryWriter
 from tqdm import trange
-from utils import Transform3D, model_to_syncbn
+from utils import BatchTransform3D, CudaPrefetcher, Transform3D, TransformView, collate_fn, preload_to_device
 
 
-def main(data_flag, output_root, num_epochs, gpu_ids, batch_size, size, conv, pretrained_3d, download, model_flag, as_rgb, shape_transform, model_path, run):
+def main(data_flag, output_root, num_epochs, gpu_ids, batch_size, size, conv, pretrained_3d, download, model_flag, as_rgb, shape_transform, model_path, run, num_workers, gpu_preload, compile, amp, deterministic, eval_every, local_rank):
 # Learning rate and scheduoler setup
     lr = 0.001 if model_flag not in ['vit3d'] else 0.0001
     gamma=0.1
     milestones = [0.5 * num_epochs, 0.75 * num_epochs]
+# cuDNN setup
+# every batch has the same shape, so the autotuner picks the fastest 3D conv algorithm once and caches it
+    torch.backends.cudnn.benchmark = not deterministic
+    torch.backends.cudnn.deterministic = deterministic
+    if not deterministic:
+        torch.set_float32_matmul_precision('high')
 # Dataset Information 
     info = INFO[data_flag]
     task = info['task']
@@ -32,48 +39,79 @@ def main(data_flag, output_root, num_epochs, gpu_ids, batch_size, size, conv, pr
 
     DataClass = getattr(medmnist, info['python_class'])
     #GPU setup
-    #this parses the gpu ids and set the environment variables for CUDA devices 
-    str_ids = gpu_ids.split(',')
-    gpu_ids = []
-    for str_id in str_ids:
-        id = int(str_id)
-        if id >= 0:
-            gpu_ids.append(id)
-    if len(gpu_ids) > 0:
-        os.environ["CUDA_VISIBLE_DEVICES"]=str(gpu_ids[0])
-
-    device = torch.device('cuda:{}'.format(gpu_ids[0])) if gpu_ids else torch.device('cpu') 
+    #when launched with torchrun (WORLD_SIZE > 1) every process drives the GPU given by its local rank and gpu_ids is ignored
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    distributed = world_size > 1
+    if distributed:
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group('nccl')
+        rank = dist.get_rank()
+        device = torch.device('cuda:{}'.format(local_rank))
+    else:
+        #this parses the gpu ids and set the environment variables for CUDA devices 
+        str_ids = gpu_ids.split(',')
+        gpu_ids = []
+        for str_id in str_ids:
+            id = int(str_id)
+            if id >= 0:
+                gpu_ids.append(id)
+        if len(gpu_ids) > 0:
+            os.environ["CUDA_VISIBLE_DEVICES"]=str(gpu_ids[0])
+
+        rank = 0
+        device = torch.device('cuda:{}'.format(gpu_ids[0])) if gpu_ids else torch.device('cpu') 
     
-        
+    #only the first process writes checkpoints, logs and evaluation csv files
     output_root = os.path.join(output_root, data_flag, time.strftime("%y%m%d_%H%M%S"))
-    if not os.path.exists(output_root):
+    if rank == 0 and not os.path.exists(output_root):
         os.makedirs(output_root)
+    save_folder = output_root if rank == 0 else None
 
-    print('==> Preparing data...')
+    if rank == 0:
+        print('==> Preparing data...')
 
-    train_transform = Transform3D(mul='random') if shape_transform else Transform3D()
+    #the random train scaling runs on the device once a batch has been loaded, the host side only casts to float32
+    train_transform = Transform3D()
+    train_batch_transform = BatchTransform3D(mul='random') if shape_transform else None
     eval_transform = Transform3D(mul='0.5') if shape_transform else Transform3D()
      
-    train_dataset = DataClass(split='train', transform=train_transform, download=download, as_rgb=as_rgb, size=size)
-    train_dataset_at_eval = DataClass(split='train', transform=eval_transform, download=download, as_rgb=as_rgb, size=size)
+    #with DDP the first process builds the datasets (downloading the npz if needed) on its own, the others wait and then only read the file
+    if distributed and rank != 0:
+        dist.barrier()
+    #the train split is loaded once and shared by the training and evaluation views, which only differ in their transform
+    train_base = DataClass(split='train', transform=None, download=download, as_rgb=as_rgb, size=size)
+    train_dataset = TransformView(train_base, train_transform)
+    train_dataset_at_eval = TransformView(train_base, eval_transform)
     val_dataset = DataClass(split='val', transform=eval_transform, download=download, as_rgb=as_rgb, size=size)
     test_dataset = DataClass(split='test', transform=eval_transform, download=download, as_rgb=as_rgb, size=size)
+    if distributed and rank == 0:
+        dist.barrier()
+
+    #GPU preloading - the 28^3 splits are small enough to stay resident on the GPU, which removes per-batch H2D copies
+    if gpu_preload:
+        if device.type == 'cuda' and size == 28:
+            train_dataset = preload_to_device(train_dataset, device)
+            #without shape_transform both train views apply the same Transform3D(), so they share one resident copy
+            train_dataset_at_eval = preload_to_device(train_dataset_at_eval, device) if shape_transform else train_dataset
+            val_dataset = preload_to_device(val_dataset, device)
+            test_dataset = preload_to_device(test_dataset, device)
+        elif rank == 0:
+            print('gpu_preload needs a CUDA device and size=28, falling back to host data loading')
+
+    #Samplers - with DDP every process only loads its own shard of each split
+    train_sampler = data.distributed.DistributedSampler(train_dataset, shuffle=True) if distributed else None
+    train_sampler_at_eval = data.distributed.DistributedSampler(train_dataset_at_eval, shuffle=False) if distributed else None
+    val_sampler = data.distributed.DistributedSampler(val_dataset, shuffle=False) if distributed else None
+    test_sampler = data.distributed.DistributedSampler(test_dataset, shuffle=False) if distributed else None
 
     #Data Loaders
-    train_loader = data.DataLoader(dataset=train_dataset,
-                                batch_size=batch_size,
-                                shuffle=True)
-    train_loader_at_eval = data.DataLoader(dataset=train_dataset_at_eval,
-                                batch_size=batch_size,
-                                shuffle=False)
-    val_loader = data.DataLoader(dataset=val_dataset,
-                                batch_size=batch_size,
-                                shuffle=False)
-    test_loader = data.DataLoader(dataset=test_dataset,
-                                batch_size=batch_size,
-                                shuffle=False)
+    train_loader = build_loader(train_dataset, batch_size, True, train_sampler, device, num_workers)
+    train_loader_at_eval = build_loader(train_dataset_at_eval, batch_size, False, train_sampler_at_eval, device, num_workers)
+    val_loader = build_loader(val_dataset, batch_size, False, val_sampler, device, num_workers)
+    test_loader = build_loader(test_dataset, batch_size, False, test_sampler, device, num_workers)
     #Model Initialization
-    print('==> Building and training model...')
+    if rank == 0:
+        print('==> Building and training model...')
 
     if model_flag == 'resnet18':
         model = ResNet18(in_channels=n_channels, num_classes=n_classes)
@@ -83,36 +121,56 @@ def main(data_flag, output_root, num_epochs, gpu_ids, batch_size, size, conv, pr
         model = VisionTransformer3D(num_classes=n_classes)
     else:
         raise NotImplementedError
-    #convolution conversion - this determines the type of convolution to be used also uses model_to_syncbn to apply sunchronized batch normalization 
-    #Synchronized Batch Normalization (SyncBN) is a type of batch normalization used for multi-GPU training. Standard batch normalization only normalizes the data within each device (GPU). SyncBN normalizes the input within the whole mini-batch.
+    #convolution conversion - this determines the type of convolution to be used
     if conv=='ACSConv':
-        model = model_to_syncbn(ACSConverter(model))
+        model = ACSConverter(model)
     if conv=='Conv2_5d':
-        model = model_to_syncbn(Conv2_5dConverter(model))
+        model = Conv2_5dConverter(model)
     if conv=='Conv3d':
         if pretrained_3d == 'i3d':
-            model = model_to_syncbn(Conv3dConverter(model, i3d_repeat_axis=-3))
+            model = Conv3dConverter(model, i3d_repeat_axis=-3)
         else:
-            model = model_to_syncbn(Conv3dConverter(model, i3d_repeat_axis=None))
+            model = Conv3dConverter(model, i3d_repeat_axis=None)
+    #Synchronized Batch Normalization (SyncBN) is a type of batch normalization used for multi-GPU training. Standard batch normalization only normalizes the data within each device (GPU). SyncBN normalizes the input within the whole mini-batch.
+    #on a single device it is pure overhead, so the native SyncBatchNorm is only used once a process group is running
+    if dist.is_available() and dist.is_initialized():
+        model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
     
     model = model.to(device)
+    #NDHWC layout lets cuDNN run the Conv3d kernels without internal NCDHW <-> NDHWC conversions
+    #only 5D (Conv3d) weights are converted - ACSConv and Conv2_5d keep 2D kernels that channels_last_3d can't hold
+    for param in model.parameters():
+        if param.dim() == 5:
+            param.data = param.data.contiguous(memory_format=torch.channels_last_3d)
+    #net is the (DDP-wrapped and/or compiled) handle used for training; it shares parameters with model, whose state_dict keeps the plain keys
+    net = model
+    if distributed:
+        net = nn.parallel.DistributedDataParallel(model, device_ids=[local_rank])
+    #torch.compile traces the converted model so Inductor can fuse the conv + BN + ReLU kernels
+    if compile:
+        net = torch.compile(net, mode='reduce-overhead', fullgraph=False)
  #Evaluators
     train_evaluator = medmnist.Evaluator(data_flag, 'train', size=size)
     val_evaluator = medmnist.Evaluator(data_flag, 'val', size=size)
     test_evaluator = medmnist.Evaluator(data_flag, 'test', size=size)
 # loss function
     criterion = nn.CrossEntropyLoss()
+# mixed precision
+# bf16 is the default where the GPU supports it (Ampere+) since it needs no loss scaling, fp16 goes through the GradScaler
+    if amp is None:
+        amp = 'bf16' if device.type == 'cuda' and torch.cuda.get_device_capability(device) >= (8, 0) else 'off'
+    amp_dtype = {'off': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}[amp]
+    scaler = torch.amp.GradScaler(device.type, enabled=(amp == 'fp16'))
 # model loading
     if model_path is not None:
         model.load_state_dict(torch.load(model_path, map_location=device)['net'], strict=True)
          #that was loading pre-trained model which is if a model path is prvioded, the models state directory is loaded 
-        train_metrics = test(model, train_evaluator, train_loader_at_eval, criterion, device, run, output_root)
-        val_metrics = test(model, val_evaluator, val_loader, criterion, device, run, output_root)
-        test_metrics = test(model, test_evaluator, test_loader, criterion, device, run, output_root)
+        train_metrics, val_metrics, test_metrics = test_all(net, [(train_evaluator, train_loader_at_eval), (val_evaluator, val_loader), (test_evaluator, test_loader)], criterion, device, run, save_folder, amp_dtype)
 
-        print('train  auc: %.5f  acc: %.5f\n' % (train_metrics[1], train_metrics[2]) + \
-              'val  auc: %.5f  acc: %.5f\n' % (val_metrics[1], val_metrics[2]) + \
-              'test  auc: %.5f  acc: %.5f\n' % (test_metrics[1], test_metrics[2]))
+        if rank == 0:
+            print('train  auc: %.5f  acc: %.5f\n' % (train_metrics[1], train_metrics[2]) + \
+                  'val  auc: %.5f  acc: %.5f\n' % (val_metrics[1], val_metrics[2]) + \
+                  'test  auc: %.5f  acc: %.5f\n' % (test_metrics[1], test_metrics[2]))
 
     if num_epochs == 0:
         return
@@ -127,59 +185,73 @@ def main(data_flag, output_root, num_epochs, gpu_ids, batch_size, size, conv, pr
     train_logs = ['train_'+log for log in logs]
     val_logs = ['val_'+log for log in logs]
     test_logs = ['test_'+log for log in logs]
-    log_dict = OrderedDict.fromkeys(train_logs+val_logs+test_logs, 0)
     
-    writer = SummaryWriter(log_dir=os.path.join(output_root, 'Tensorboard_Results'))
+    writer = SummaryWriter(log_dir=os.path.join(output_root, 'Tensorboard_Results')) if rank == 0 else None
 #Training loop
 #this is the training loop, it iterates over the num of epochs  
     best_auc = 0
     best_epoch = 0
-    best_model = deepcopy(model)
+    best_state = None
 
     global iteration
     iteration = 0
 
-    for epoch in trange(num_epochs):
+    for epoch in trange(num_epochs, disable=(rank != 0)):
          #training calls 'train' functiom for a trainin epoch
-        #evaluation evaluates teh model on training validation and test sets 
-        train_loss = train(model, train_loader, criterion, optimizer, device, writer)
+        #evaluation only runs on the validation set, which drives model selection
+        #train and test sets are evaluated every eval_every epochs (if set) and once on the best model after training
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        train_loss = train(net, train_loader, criterion, optimizer, device, writer, scaler, amp_dtype, train_batch_transform)
         
-        train_metrics = test(model, train_evaluator, train_loader_at_eval, criterion, device, run)
-        val_metrics = test(model, val_evaluator, val_loader, criterion, device, run)
-        test_metrics = test(model, test_evaluator, test_loader, criterion, device, run)
+        val_metrics = test(net, val_evaluator, val_loader, criterion, device, run, amp_dtype=amp_dtype)
         #scheduler adjusts the learning rate according to how teh scheduler was specififed 
         scheduler.step()
         #this loggis is what logss the metrics to tensorboard 
-        for i, key in enumerate(train_logs):
-            log_dict[key] = train_metrics[i]
+        log_dict = OrderedDict(train_loss=train_loss)
         for i, key in enumerate(val_logs):
             log_dict[key] = val_metrics[i]
-        for i, key in enumerate(test_logs):
-            log_dict[key] = test_metrics[i]
-
-        for key, value in log_dict.items():
-            writer.add_scalar(key, value, epoch)
+        if eval_every > 0 and (epoch + 1) % eval_every == 0:
+            train_metrics, test_metrics = test_all(net, [(train_evaluator, train_loader_at_eval), (test_evaluator, test_loader)], criterion, device, run, amp_dtype=amp_dtype)
+            for i, key in enumerate(train_logs[1:], 1):
+                log_dict[key] = train_metrics[i]
+            for i, key in enumerate(test_logs):
+                log_dict[key] = test_metrics[i]
+
+        if writer is not None:
+            for key, value in log_dict.items():
+                writer.add_scalar(key, value, epoch)
         #best model tracks the best model based on validation AUC and saves it in state
         cur_auc = val_metrics[1]
         if cur_auc > best_auc:
             best_epoch = epoch
             best_auc = cur_auc
-            best_model = deepcopy(model)
+            #only the weights are snapshotted (on CPU), the module graph itself is reused
+            best_state = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
 
-            print('cur_best_auc:', best_auc)
-            print('cur_best_epoch', best_epoch)
+            if rank == 0:
+                print('cur_best_auc:', best_auc)
+                print('cur_best_epoch', best_epoch)
+
+    #best_state is already a CPU copy, so it is saved as is instead of copying the weights back off the device
+    if best_state is not None:
+        model.load_state_dict(best_state)
+    else:
+        best_state = model.state_dict()
 
     state = {
-        'net': model.state_dict(),
+        'net': best_state,
     }
 
-    path = os.path.join(output_root, 'best_model.pth')
-    torch.save(state, path)
+    if rank == 0:
+        path = os.path.join(output_root, 'best_model.pth')
+        torch.save(state, path, _use_new_zipfile_serialization=True)
     # final evaluation and logging 
     #this evaluates the best model we saved during training (checkpoints?) and evaluates the model
-    train_metrics = test(best_model, train_evaluator, train_loader_at_eval, criterion, device, run, output_root)
-    val_metrics = test(best_model, val_evaluator, val_loader, criterion, device, run, output_root)
-    test_metrics = test(best_model, test_evaluator, test_loader, criterion, device, run, output_root)
+    train_metrics, val_metrics, test_metrics = test_all(net, [(train_evaluator, train_loader_at_eval), (val_evaluator, val_loader), (test_evaluator, test_loader)], criterion, device, run, save_folder, amp_dtype)
+
+    if rank != 0:
+        return
 
     train_log = 'train  auc: %.5f  acc: %.5f\n' % (train_metrics[1], train_metrics[2])
     val_log = 'val  auc: %.5f  acc: %.5f\n' % (val_metrics[1], val_metrics[2])
@@ -192,6 +264,28 @@ def main(data_flag, output_root, num_epochs, gpu_ids, batch_size, size, conv, pr
         f.write(log)        
             
     writer.close()
+#DataLoader construction
+#preloaded datasets already live on the GPU - CUDA tensors can't be pinned or handed to forked worker processes,
+#so every batch is gathered from the resident tensors with a single index (BatchSampler + batch_size=None) instead of sample by sample
+#pinned host memory lets the non_blocking copies in train/test overlap with GPU compute
+def build_loader(dataset, batch_size, shuffle, sampler, device, num_workers):
+    if isinstance(dataset, data.TensorDataset):
+        if sampler is None:
+            sampler = data.RandomSampler(dataset) if shuffle else data.SequentialSampler(dataset)
+        return data.DataLoader(dataset=dataset,
+                                batch_size=None,
+                                sampler=data.BatchSampler(sampler, batch_size, drop_last=False))
+
+    kwargs = {'pin_memory': device.type == 'cuda', 'num_workers': num_workers}
+    if num_workers > 0:
+        kwargs.update(persistent_workers=True, prefetch_factor=4)
+    return data.DataLoader(dataset=dataset,
+                            batch_size=batch_size,
+                            shuffle=(shuffle and sampler is None),
+                            sampler=sampler,
+                            collate_fn=collate_fn,
+                            **kwargs)
+
 #training function 
 #training loop iterates over the training data
 #forward pass computes the model ouputs 
@@ -200,58 +294,108 @@ def main(data_flag, output_root, num_epochs, gpu_ids, batch_size, size, conv, pr
 # optimizer step updates the model parameters
 # logging logs te loss to tensorboard 
 
-def train(model, train_loader, criterion, optimizer, device, writer):
-    total_loss = []
+def train(model, train_loader, criterion, optimizer, device, writer, scaler, amp_dtype=None, batch_transform=None):
+    step_losses = torch.empty(len(train_loader), device=device)
     global iteration
 
     model.train()
-    for batch_idx, (inputs, targets) in enumerate(train_loader):
-        optimizer.zero_grad()
-        outputs = model(inputs.to(device))
+    for batch_idx, (inputs, targets) in enumerate(CudaPrefetcher(train_loader, device, memory_format=torch.channels_last_3d)):
+        if batch_transform is not None:
+            inputs = batch_transform(inputs)
 
-        targets = torch.squeeze(targets, 1).long().to(device)
-        loss = criterion(outputs, targets)
+        optimizer.zero_grad(set_to_none=True)
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            outputs = model(inputs)
+            loss = criterion(outputs, targets)
 
-        total_loss.append(loss.item())
-        writer.add_scalar('train_loss_logs', loss.item(), iteration)
-        iteration += 1
+        step_losses[batch_idx] = loss.detach()
 
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
     
-    epoch_loss = sum(total_loss)/len(total_loss)
+    #with DDP each process only trained on its own shard, so the step losses are averaged over all processes
+    if dist.is_available() and dist.is_initialized():
+        dist.all_reduce(step_losses)
+        step_losses /= dist.get_world_size()
+
+    #step losses stay on the device during the epoch and are flushed to tensorboard in one go
+    step_losses = step_losses.tolist()
+    for step_loss in step_losses:
+        if writer is not None:
+            writer.add_scalar('train_loss_logs', step_loss, iteration)
+        iteration += 1
+
+    epoch_loss = sum(step_losses)/len(step_losses)
     return epoch_loss
 
 #Test function 
 # testing loop iterates over the evaluation data without gradient computation
 # forward pass, loss calc and metric calculations (AUC and ACC) then logging the mtrics 
-def test(model, evaluator, data_loader, criterion, device, run, save_folder=None):
+def test(model, evaluator, data_loader, criterion, device, run, save_folder=None, amp_dtype=None):
+    return test_all(model, [(evaluator, data_loader)], criterion, device, run, save_folder, amp_dtype)[0]
+
+#evaluates several splits at once: all forward passes are queued back-to-back on the device
+#and the scores are only copied back to the host (and passed to the evaluators) once every split is done
+def test_all(model, evaluators_and_loaders, criterion, device, run, save_folder=None, amp_dtype=None):
 
     model.eval()
 
-    total_loss = []
-    y_score = torch.tensor([]).to(device)
+    with torch.inference_mode():
+        predictions = [predict(model, data_loader, criterion, device, amp_dtype) for _, data_loader in evaluators_and_loaders]
+        if dist.is_available() and dist.is_initialized():
+            predictions = [gather_predictions(*prediction, len(data_loader.dataset)) for prediction, (_, data_loader) in zip(predictions, evaluators_and_loaders)]
 
-    with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(data_loader):
-            outputs = model(inputs.to(device))
-        
-            targets = torch.squeeze(targets, 1).long().to(device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+    metrics = []
+    for (evaluator, _), (loss_sum, n_batches, y_score) in zip(evaluators_and_loaders, predictions):
+        y_score = y_score.cpu().numpy()
+        auc, acc = evaluator.evaluate(y_score, save_folder, run)
+
+        test_loss = (loss_sum / n_batches).item()
+        metrics.append([test_loss, auc, acc])
+
+    return metrics
+
+#forward passes over one split, returns the loss sum, batch count and softmax scores still on the device
+def predict(model, data_loader, criterion, device, amp_dtype=None):
+
+    loss_sum = torch.zeros((), device=device)
+    n_batches = 0
+    #scores are written into one buffer sized for the whole split, allocated once the class count is known
+    y_score = None
+    offset = 0
+
+    for batch_idx, (inputs, targets) in enumerate(CudaPrefetcher(data_loader, device, memory_format=torch.channels_last_3d)):
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            outputs = model(inputs)
             loss = criterion(outputs, targets)
-            m = nn.Softmax(dim=1)
-            outputs = m(outputs).to(device)
-            targets = targets.float().resize_(len(targets), 1)
 
-            total_loss.append(loss.item())
+        loss_sum += loss.detach()
+        n_batches += 1
 
-            y_score = torch.cat((y_score, outputs), 0)
+        if y_score is None:
+            y_score = torch.empty((len(data_loader.dataset), outputs.size(1)), device=device)
+        bs = outputs.size(0)
+        y_score[offset:offset+bs] = F.softmax(outputs.float(), dim=1)
+        offset += bs
 
-        y_score = y_score.detach().cpu().numpy()
-        auc, acc = evaluator.evaluate(y_score, save_folder, run)
+    return loss_sum, n_batches, y_score[:offset]
 
-        test_loss = sum(total_loss) / len(total_loss)
+#with DDP each process only scores its DistributedSampler shard (samples rank, rank + world_size, ...),
+#so the shards are gathered and interleaved back into dataset order, dropping the sampler's padding at the end
+def gather_predictions(loss_sum, n_batches, y_score, n_samples):
+    n_batches = torch.tensor(n_batches, device=loss_sum.device)
+    dist.all_reduce(loss_sum)
+    dist.all_reduce(n_batches)
 
-        return [test_loss, auc, acc]
+    shards = [torch.empty_like(y_score) for _ in range(dist.get_world_size())]
+    dist.all_gather(shards, y_score)
+    y_score = torch.stack(shards, dim=1).view(-1, y_score.size(1))[:n_samples]
+
+    return loss_sum, n_batches, y_score
 
 #argument passing: parser.add_argument defines all the Command line arguments that teh script can accept 
 if __name__ == '__main__':
@@ -275,9 +419,11 @@ if __name__ == '__main__':
                         type=int)
     parser.add_argument('--gpu_ids',
                         default='0',
+                        help='ignored when launched with torchrun, every process then uses the GPU of its local rank',
                         type=str)
     parser.add_argument('--batch_size',
                         default=32,
+                        help='batch size per process',
                         type=int)
     parser.add_argument('--conv',
                         default='ACSConv',
@@ -306,6 +452,32 @@ if __name__ == '__main__':
                         default='model1',
                         help='to name a standard evaluation csv file, named as {flag}_{split}_[AUC]{auc:.3f}_[ACC]{acc:.3f}@{run}.csv',
                         type=str)
+    parser.add_argument('--num_workers',
+                        default=4,
+                        help='num of DataLoader worker processes, 0 loads data in the main process',
+                        type=int)
+    parser.add_argument('--gpu_preload',
+                        help='keep the whole dataset on the GPU, only used for size=28',
+                        action="store_true")
+    parser.add_argument('--compile',
+                        help='wrap the model with torch.compile (PyTorch 2.0+)',
+                        action="store_true")
+    parser.add_argument('--amp',
+                        default=None,
+                        choices=['off', 'fp16', 'bf16'],
+                        help='mixed precision mode, default=bf16 on GPUs that support it, off otherwise',
+                        type=str)
+    parser.add_argument('--deterministic',
+                        help='disable cuDNN autotuning and TF32 matmuls for reproducible runs',
+                        action="store_true")
+    parser.add_argument('--eval_every',
+                        default=0,
+                        help='also evaluate on the train and test sets every N epochs, default=0 only evaluates them after training',
+                        type=int)
+    parser.add_argument('--local_rank',
+                        default=int(os.environ.get('LOCAL_RANK', 0)),
+                        help='GPU of this process for multi-GPU training, set by torchrun, e.g. torchrun --nproc_per_node=4 train_and_eval_pytorch.py ...',
+                        type=int)
 
 
     args = parser.parse_args()
@@ -323,5 +495,15 @@ if __name__ == '__main__':
     model_path = args.model_path
     shape_transform = args.shape_transform
     run = args.run
-
-    main(data_flag, output_root, num_epochs, gpu_ids, batch_size, size, conv, pretrained_3d, download, model_flag, as_rgb, shape_transform, model_path, run)
+    num_workers = args.num_workers
+    gpu_preload = args.gpu_preload
+    compile = args.compile
+    amp = args.amp
+    deterministic = args.deterministic
+    eval_every = args.eval_every
+    local_rank = args.local_rank
+
+    main(data_flag, output_root, num_epochs, gpu_ids, batch_size, size, conv, pretrained_3d, download, model_flag, as_rgb, shape_transform, model_path, run, num_workers, gpu_preload, compile, amp, deterministic, eval_every, local_rank)
+
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
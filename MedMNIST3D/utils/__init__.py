@@ -1,2 +1,7 @@
 from .utils import Transform3D
-from .utils import model_to_syncbn
\ No newline at end of file
+from .utils import BatchTransform3D
+from .utils import TransformView
+from .utils import model_to_syncbn
+from .utils import CudaPrefetcher
+from .utils import preload_to_device
+from .utils import collate_fn
\ No newline at end of file
@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 import numpy as np
 from .batchnorm import SynchronizedBatchNorm3d, SynchronizedBatchNorm2d
@@ -17,6 +18,105 @@ class Transform3D:
         return voxel.astype(np.float32)
 
 
+class BatchTransform3D:
+    # the random scaling of Transform3D applied to a whole (B, C, D, H, W) batch on its device, one factor per sample
+    # the deterministic eval scaling stays on the host in Transform3D
+
+    def __init__(self, mul=None):
+        self.mul = mul
+
+    def __call__(self, voxels):
+
+        if self.mul == 'random':
+            voxels = voxels * torch.rand((voxels.size(0),) + (1,) * (voxels.dim() - 1), device=voxels.device)
+
+        return voxels
+
+
+class TransformView(torch.utils.data.Dataset):
+    # shares the arrays of an already loaded dataset and only swaps the transform applied to its inputs
+
+    def __init__(self, base, transform=None):
+        self.base = base
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.base)
+
+    def __getitem__(self, index):
+        img, target = self.base[index]
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, target
+
+
+def collate_fn(batch):
+    # stacks float32 inputs and returns targets already squeezed to the long class indices CrossEntropyLoss expects
+    inputs, targets = zip(*batch)
+    inputs = torch.stack([torch.as_tensor(x, dtype=torch.float32) for x in inputs])
+    targets = torch.squeeze(torch.stack([torch.as_tensor(t) for t in targets]), 1).long()
+    return inputs, targets
+
+
+def preload_to_device(dataset, device):
+    # materializes a whole split as two contiguous device tensors, applying the dataset transform once
+    # targets are stored squeezed and long, ready for CrossEntropyLoss
+    inputs, targets = zip(*(dataset[i] for i in range(len(dataset))))
+    inputs = torch.as_tensor(np.stack(inputs), dtype=torch.float32).to(device)
+    targets = torch.squeeze(torch.as_tensor(np.stack(targets)), 1).long().to(device)
+    return torch.utils.data.TensorDataset(inputs, targets)
+
+
+class CudaPrefetcher:
+    # copies batch N+1 to the device on a side stream while batch N is being consumed
+
+    def __init__(self, loader, device, memory_format=torch.preserve_format):
+        self.loader = loader
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iter = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        next_input, next_target = next(self.iter, (None, None))
+        if next_input is None:
+            self.next_input, self.next_target = None, None
+            return
+        # channels_last_3d only applies to 5D (B, C, D, H, W) volumes
+        memory_format = self.memory_format if next_input.dim() == 5 else torch.preserve_format
+        if self.stream is None:
+            self.next_input = next_input.to(self.device, memory_format=memory_format)
+            self.next_target = next_target.to(self.device)
+            return
+        # batches gathered from device-resident data are produced on the current stream,
+        # so the side stream waits for them and keeps their memory alive until its copy is done
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            self.next_input = next_input.to(self.device, non_blocking=True, memory_format=memory_format)
+            self.next_target = next_target.to(self.device, non_blocking=True)
+        if next_input.is_cuda:
+            next_input.record_stream(self.stream)
+            next_target.record_stream(self.stream)
+
+    def __next__(self):
+        if self.next_input is None:
+            raise StopIteration
+        inputs, targets = self.next_input, self.next_target
+        if self.stream is not None:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            inputs.record_stream(torch.cuda.current_stream(self.device))
+            targets.record_stream(torch.cuda.current_stream(self.device))
+        self.preload()
+        return inputs, targets
+
+
 def model_to_syncbn(model):
     preserve_state_dict = model.state_dict()
     _convert_module_from_bn_to_syncbn(model)